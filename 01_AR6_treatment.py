@@ -20,8 +20,17 @@
 # %%
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+from pandas.api.types import union_categoricals
 from zipfile import ZipFile
+from functools import lru_cache
+import hashlib
+import os
 import pathlib
+import shutil
 import re
 
 DATADIR = pathlib.Path('data')
@@ -33,67 +42,137 @@ OUTDIR2.mkdir(exist_ok=True)
 
 
 # %%
-def load_ar6():
-    # AR6 variables to be processed
-    archive = DATADIR / "1668008030411-AR6_Scenarios_Database_World_ALL_CLIMATE_v1.1.csv.zip"
-    cache = DATADIR / "AR6_Scenarios_Database_World_ALL_CLIMATE_subset_and_metadata_v1.1.csv"
-
-    # Use cache if possible
+# AR6 variables to be processed
+VARIABLES = ['AR6 climate diagnostics|Infilled|Emissions|Kyoto Gases (AR6-GWP100)',
+             'AR6 climate diagnostics|Surface Temperature (GSAT)|MAGICCv7.5.3|50.0th Percentile',
+             'Final Energy',
+             'Final Energy|Electricity',
+             'Carbon Sequestration|CCS|Fossil',
+             'Emissions|CO2|Energy|Supply|Electricity',
+             'Secondary Energy|Electricity',
+             'Primary Energy',
+             'Primary Energy|Fossil|w/ CCS',
+             'Primary Energy|Nuclear',
+             'Primary Energy|Renewables (incl. Biomass)',
+             'Emissions|CO2',
+             'Emissions|CO2|Energy',
+             'Emissions|CO2|AFOLU',
+             'Emissions|CO2|Waste',
+             'Emissions|CO2|Industrial Processes',
+             'Emissions|CO2|Other',
+             'Emissions|CH4',
+             'Emissions|CH4|Energy',
+             'Emissions|CH4|AFOLU',
+             'Emissions|CH4|Waste',
+             'Emissions|CH4|Industrial Processes',
+             'Emissions|CH4|Other',
+             'Emissions|N2O',
+             'Emissions|N2O|Energy',
+             'Emissions|N2O|AFOLU',
+             'Emissions|N2O|Industrial Processes',
+             'Emissions|N2O|Waste',
+             'Emissions|N2O|Other',
+             'Emissions|F-Gases']
+
+ARCHIVE = DATADIR / "1668008030411-AR6_Scenarios_Database_World_ALL_CLIMATE_v1.1.csv.zip"
+YEAR_COLS = [str(i) for i in range(2020, 2101, 10)]
+
+# The caches are keyed on the processed variables so that a changed selection is never served stale data,
+# and can be rebuilt on demand by setting AR6_FORCE_RECOMPUTE=1
+VARIABLES_KEY = hashlib.md5('|'.join(sorted(VARIABLES)).encode()).hexdigest()[:12]
+FORCE_RECOMPUTE = os.environ.get('AR6_FORCE_RECOMPUTE') == '1'
+
+
+def materialize_parquet(force=FORCE_RECOMPUTE):
+    """Converts the zipped database once into a Parquet file restricted to the processed variables and years, with one row group per variable.
+    """
+    cache = DATADIR / f"ar6_{VARIABLES_KEY}.parquet"
+    if cache.exists() and not force:
+        return cache
+
+    cols = ['Model', 'Scenario', 'Region', 'Variable', 'Unit'] + YEAR_COLS
+
+    # Stream the CSV with the multithreaded Arrow parser and keep only the processed variables of each block
+    types = {col: pa.string() for col in cols[:5]} | {col: pa.float32() for col in YEAR_COLS}
+    with ZipFile(ARCHIVE) as zipfile:
+        reader = pacsv.open_csv(zipfile.open('AR6_Scenarios_Database_World_ALL_CLIMATE_v1.1.csv'),
+                                read_options=pacsv.ReadOptions(use_threads=True, block_size=8 << 20),
+                                convert_options=pacsv.ConvertOptions(include_columns=cols, column_types=types))
+        variables = pa.array(VARIABLES)
+        data = pa.Table.from_batches([batch.filter(pc.is_in(batch['Variable'], value_set=variables)) for batch in reader])
+
+    # Id columns are stored dictionary-encoded and read back as categoricals
+    data = data.to_pandas(strings_to_categorical=True)
+    table = pa.Table.from_pandas(data, preserve_index=False)
+    with pq.ParquetWriter(cache, table.schema) as writer:
+        for _, group in data.groupby('Variable', sort=False, observed=True):
+            writer.write_table(pa.Table.from_pandas(group, schema=table.schema, preserve_index=False))
+    return cache
+
+
+@lru_cache(maxsize=None)
+def _read_meta(sheet, cols, archive):
+    """Parses the columns of a metadata sheet of an archive only once, caching them as Parquet under a name keyed on the archive, sheet and columns.
+    """
+    key = hashlib.md5('|'.join([pathlib.Path(archive).name, sheet, *cols]).encode()).hexdigest()[:12]
+    cache = DATADIR / f"ar6_{sheet}_{key}.parquet"
     if cache.exists():
-        return pd.read_csv(cache)
-
-    variables = ['AR6 climate diagnostics|Infilled|Emissions|Kyoto Gases (AR6-GWP100)',
-                 'AR6 climate diagnostics|Surface Temperature (GSAT)|MAGICCv7.5.3|50.0th Percentile',
-                 'Final Energy',
-                 'Final Energy|Electricity',
-                 'Carbon Sequestration|CCS|Fossil',
-                 'Emissions|CO2|Energy|Supply|Electricity',
-                 'Secondary Energy|Electricity',
-                 'Primary Energy',
-                 'Primary Energy|Fossil|w/ CCS',
-                 'Primary Energy|Nuclear',
-                 'Primary Energy|Renewables (incl. Biomass)',
-                 'Emissions|CO2',
-                 'Emissions|CO2|Energy',
-                 'Emissions|CO2|AFOLU',
-                 'Emissions|CO2|Waste',
-                 'Emissions|CO2|Industrial Processes',
-                 'Emissions|CO2|Other',
-                 'Emissions|CH4',
-                 'Emissions|CH4|Energy',
-                 'Emissions|CH4|AFOLU',
-                 'Emissions|CH4|Waste',
-                 'Emissions|CH4|Industrial Processes',
-                 'Emissions|CH4|Other',
-                 'Emissions|N2O',
-                 'Emissions|N2O|Energy',
-                 'Emissions|N2O|AFOLU',
-                 'Emissions|N2O|Industrial Processes',
-                 'Emissions|N2O|Waste',
-                 'Emissions|N2O|Other',
-                 'Emissions|F-Gases']
+        return pd.read_parquet(cache)
 
-    # Import the database and metadata of scenarios and a subset of variables
     with ZipFile(archive) as zipfile:
-        # Process database
-        cols = ['Model', 'Scenario', 'Region', 'Variable', 'Unit'] + [str(i) for i in range(2020, 2101, 10)]
-        data = pd.read_csv(zipfile.open('AR6_Scenarios_Database_World_ALL_CLIMATE_v1.1.csv'), usecols=cols)
-        data = data[data['Variable'].isin(variables)]
+        meta = pd.read_excel(zipfile.open('AR6_Scenarios_Database_metadata_indicators_v1.1.xlsx'), sheet_name=sheet, usecols=list(cols))
+    meta.to_parquet(cache)
+    return meta
 
-        # Process metadata
-        cols = ['Model', 'Scenario', 'Category', 'IMP_marker']
-        meta = pd.read_excel(zipfile.open('AR6_Scenarios_Database_metadata_indicators_v1.1.xlsx'), sheet_name='meta_Ch3vetted_withclimate', usecols=cols)
 
-    # Combine dataframes
-    cols = ['Model', 'Scenario', 'Region', 'Variable', 'Unit', 'Year', 'Value', 'Category', 'IMP_marker']
-    df = meta.merge(data, on=['Model', 'Scenario'], how='right')
-    df = pd.melt(df, id_vars=df.columns[:7], var_name='Year', value_name='Value')
-    df.to_csv(cache, index=False)
-    return df
+def load_meta(sheet='meta_Ch3vetted_withclimate', cols=('Model', 'Scenario', 'Category', 'IMP_marker'), archive=ARCHIVE):
+    """Imports a metadata sheet of the scenarios, shared between the loaders; each caller gets its own copy of the parsed sheet.
+    """
+    return _read_meta(sheet, tuple(cols), archive).copy()
 
 
-# %%
-df = load_ar6()
+def load_ar6(cat, force=FORCE_RECOMPUTE):
+    """Imports the database of scenarios and their metadata for the category specified by the user, one row per scenario and variable with a column per year.
+    """
+    cache = DATADIR / f"AR6_Scenarios_Database_World_ALL_CLIMATE_subset_and_metadata_wide_f64_{VARIABLES_KEY}_v1.1.parquet"
+
+    # Build the cache of all categories once, partitioned by category so that switching category reads a single directory
+    if force or not cache.exists():
+        subset = DATADIR / "AR6_Scenarios_Database_World_ALL_CLIMATE_subset_and_metadata_v1.1.csv"
+        df = pd.read_csv(subset).dropna(subset=['Category']) if subset.exists() else None
+        if df is not None and set(VARIABLES).issubset(df['Variable'].unique()):
+            # The extract shipped in the data folder already combines data and metadata of all categories, in long form,
+            # and is used as long as it covers every processed variable
+            df = df[df['Variable'].isin(VARIABLES)]
+            df = (df.pivot(index=['Model', 'Scenario', 'Category', 'IMP_marker', 'Region', 'Variable', 'Unit'], columns='Year', values='Value')
+                    .rename(columns=str).reindex(columns=YEAR_COLS).rename_axis(columns=None).reset_index())
+        else:
+            # Import the database and metadata of scenarios and a subset of variables
+            data = pd.read_parquet(materialize_parquet(force))
+            meta = load_meta()
+
+            # Share the categories of the join keys so that the merge works on integer codes
+            meta = meta.dropna(subset=['Category']).copy()
+            for key in ['Model', 'Scenario']:
+                categories = union_categoricals([pd.Categorical(data[key]), pd.Categorical(meta[key])]).categories
+                data[key] = pd.Categorical(data[key], categories=categories)
+                meta[key] = pd.Categorical(meta[key], categories=categories)
+
+            # Combine dataframes, keeping only the categorised scenarios and the year columns as they are
+            df = meta.merge(data, on=['Model', 'Scenario'], how='inner')
+
+        df = df.astype({'Model': 'category', 'Scenario': 'category', 'Category': 'category', 'IMP_marker': 'category',
+                        'Region': 'category', 'Variable': 'category', 'Unit': 'category'} | {col: 'float64' for col in YEAR_COLS})
+        if cache.exists():
+            shutil.rmtree(cache)
+        df.to_parquet(cache, partition_cols=['Category'], compression='zstd', row_group_size=100_000)
+
+    # Only the partition of the category is opened; Parquet returns categories in order of appearance, so the lexical order is restored
+    df = pd.read_parquet(cache, filters=[('Category', '==', cat)])
+    for col in ['Model', 'Scenario', 'IMP_marker']:
+        df[col] = df[col].cat.reorder_categories(df[col].cat.categories.sort_values())
+    return df
+
 
 # %% [markdown]
 # The following variables are either those given in Tables 3.2 and 3.4 of IPCC AR6 WGIII Chapter 3 (([Riahi et al., 2023](https://www.cambridge.org/core/books/climate-change-2022-mitigation-of-climate-change/mitigation-pathways-compatible-with-longterm-goals/7C750344E39ECA3BD5CB14156FCEEFE9)) or are furtherly computed to retrieve these variables.
@@ -101,144 +180,113 @@ df = load_ar6()
 # %%
 # Load the AR6 Scenarios Database for a given category and set of variables
 cat = 'C1'
-dfc = df[df['Category'] == cat]
+dfc = load_ar6(cat)
 
 # %%
 # Check that the number of scenarios within the explored category matches the IPCC records
 dfc[['Model', 'Scenario']].drop_duplicates().shape[0]  # 97 for C1
 
-
 # %%
-# Compute statictical and extract IMP scenarios
-def process_scenarios(df):
-    stat = (df.groupby('Year')['Value'].quantile([0.05, 0.50, 0.95])
-              .unstack().set_axis(pd.Index(['5th', 'Median', '95th'], name='Scenario'), axis=1)
-              .stack().rename('Value').swaplevel().sort_index().reset_index())
+# Arrange the category in a single wide matrix of scenarios (rows) by variables and years (columns)
+wide = (dfc.set_index(['Scenario', 'Model', 'IMP_marker', 'Variable'])[YEAR_COLS].rename(columns=np.int16).rename_axis(columns='Year')
+           .unstack('Variable').swaplevel(axis=1).sort_index())
+years = wide.columns.unique('Year').sort_values()
+wide = wide.reindex(columns=pd.MultiIndex.from_product([wide.columns.unique('Variable'), years]))
+
+arr = wide.to_numpy(dtype='float32')
+var_idx = {var: wide.columns.get_loc(var) for var in wide.columns.unique('Variable')}  # column slice of each variable, looked up once
+get_var = lambda var: arr[:, var_idx[var]]  # (scenarios, years) block of a variable
 
-    imp = (df[df['IMP_marker'] != 'non-IMP']
-             .assign(Scenario=lambda x: 'IMP-' + x['IMP_marker'])
-             .drop(columns=['IMP_marker', 'Model']))
 
-    return pd.concat([stat, imp], ignore_index=True)
+# %%
+def nanquantile(cube, q):
+    """Computes np.nanquantile(cube, q, axis=0) with linear interpolation for all columns at once, instead of one call per column.
+    """
+    count = (~np.isnan(cube)).sum(axis=0)
 
+    # Fractional rank of each quantile among the valid values of each column
+    rank = np.multiply.outer(q, count - 1)
+    lo = np.floor(rank).astype(int).clip(0)
+    hi = np.minimum(lo + 1, count - 1).clip(0)
+    frac = rank - lo
+
+    # Only the order statistics around these ranks are needed, NaNs are partitioned last
+    ordered = np.partition(cube, np.union1d(lo, hi), axis=0)
+    below = np.take_along_axis(ordered, lo, axis=0)
+    above = np.take_along_axis(ordered, hi, axis=0)
+    diff = above - below
+    return np.where(frac >= 0.5, above - diff * (1 - frac), below + diff * frac)
 
-# %% [markdown]
-# ## Electricity share of final energy (ESFE)
 
 # %%
-# Filter necessary variables to compute the ratio of electricity in final energy demand globally
-var = ['Final Energy', 'Final Energy|Electricity']
-esfe = dfc[dfc['Variable'].isin(var)]
+# Compute statictical and extract IMP scenarios for all metrics at once
+def process_scenarios(metrics, index, years):
+    """Computes the 5th, 50th and 95th percentiles of each (scenarios, years) metric array and appends the IMP scenarios in a single (Scenario, Year) x metric frame.
+    """
+    cube = np.stack(list(metrics.values()), axis=1)  # (scenarios, metrics, years)
+    stat = nanquantile(cube, np.array([0.05, 0.95, 0.50]))
 
-# Calculate the ratio of electricity in final energy
-calc_esfe = lambda x: x['Final Energy|Electricity'] / x['Final Energy']
+    marker = index.get_level_values('IMP_marker')
+    is_imp = marker != 'non-IMP'
+    values = np.concatenate([stat, cube[is_imp]])
 
-esfe = (pd.pivot(esfe, columns='Variable', index=['IMP_marker', 'Model', 'Scenario', 'Year'], values='Value')
-          .sort_values(['Scenario', 'Year'])
-          .reset_index().rename_axis(columns=None)
-          .assign(Value=calc_esfe)
-          .drop(columns=var))
+    scenarios = ['5th', '95th', 'Median'] + ['IMP-' + m for m in marker[is_imp]]
+    return pd.DataFrame(values.transpose(0, 2, 1).reshape(-1, len(metrics)), columns=pd.Index(metrics.keys(), name='Variable'),
+                        index=pd.MultiIndex.from_product([scenarios, years], names=['Scenario', 'Year']))
 
-esfe = process_scenarios(esfe).assign(Value=lambda x: x['Value'].round(2))  # percentage
 
 # %% [markdown]
-# ## Greenhouse gases (GHG)
+# ## Electricity share of final energy (ESFE)
 
 # %%
-# Filter only the necessary variable
-var = ['AR6 climate diagnostics|Infilled|Emissions|Kyoto Gases (AR6-GWP100)']
-ghg = dfc[dfc['Variable'].isin(var)]
+# Calculate the ratio of electricity in final energy
+esfe = get_var('Final Energy|Electricity') / get_var('Final Energy')
 
-ghg = (ghg.drop(columns=['Category', 'Region', 'Unit', 'Variable'])
-          .sort_values(['Scenario', 'Year']))
+# %% [markdown]
+# ## Greenhouse gases (GHG)
 
-ghg = process_scenarios(ghg).assign(Value=lambda x: x['Value'].round(0).div(1000))  # to obtain values in Gt
+# %%
+ghg = get_var('AR6 climate diagnostics|Infilled|Emissions|Kyoto Gases (AR6-GWP100)')
 
 # %% [markdown]
 # ## Final energy demand (FED)
 
 # %%
-# Filter only the necessary variable
-var = ['Final Energy']
-fed = dfc[dfc['Variable'].isin(var)]
-
-fed = (fed.drop(columns=['Category', 'Region', 'Unit', 'Variable'])
-          .sort_values(['Scenario', 'Year']))
-
-fed = process_scenarios(fed).assign(Value=lambda x: x['Value'].round(0))
+fed = get_var('Final Energy')
 
 # %% [markdown]
 # ## Fossil CO<sub>2</sub> (CCSFOS)
 
 # %%
-# Filter only the necessary variable
-var = ['Carbon Sequestration|CCS|Fossil']
-ccsfos = dfc.loc[dfc['Variable'].isin(var)]
-
-ccsfos = (ccsfos.drop(columns=['Category', 'Region', 'Unit', 'Variable'])
-                .sort_values(['Scenario', 'Year']))
-
-ccsfos = process_scenarios(ccsfos).assign(Value=lambda x: x['Value'].round(0).div(1000))  # to obtain values in Gt
+ccsfos = get_var('Carbon Sequestration|CCS|Fossil')
 
 # %% [markdown]
 # ## CO<sub>2</sub> intensity of electricity (CO2ELC)
 
 # %%
-# Filter variables needed to calculate the ratio of carbon content of electricity to electricity generation
-var = ['Secondary Energy|Electricity', 'Emissions|CO2|Energy|Supply|Electricity']
-co2elc = dfc[dfc['Variable'].isin(var)]
-
 # Calculate the carbon content of electricity
-calc_co2elc = lambda x: x['Emissions|CO2|Energy|Supply|Electricity'] / x['Secondary Energy|Electricity'] * 3.6
-
-co2elc = (pd.pivot(co2elc, columns='Variable', index=['IMP_marker', 'Model', 'Scenario', 'Year'], values='Value')
-          .sort_values(['Scenario', 'Year'])
-          .reset_index().rename_axis(columns=None)
-          .assign(Value=calc_co2elc)
-          .drop(columns=var))
-
-co2elc = process_scenarios(co2elc).assign(Value=lambda x: x['Value'].round(0))
+co2elc = get_var('Emissions|CO2|Energy|Supply|Electricity') / get_var('Secondary Energy|Electricity') * 3.6
 
 # %% [markdown]
 # ## Low-carbon share of primary energy (LCSPE)
 # According to IPCC AR6, the low-carbon share of energy includes *renewables (including biomass, solar, wind, hydro, geothermal, ocean); fossil fuels when used with CCS; and, nuclear power.*
 
 # %%
-# Filter variables needed to calculate the low-carbon share of primary energy
-var = ['Primary Energy', 'Primary Energy|Fossil|w/ CCS','Primary Energy|Nuclear', 'Primary Energy|Renewables (incl. Biomass)']
-lcspe = dfc.loc[dfc['Variable'].isin(var)]
-
 # Calculate the low-carbon share of primary energy
-calc_lcspe = lambda x: x[['Primary Energy|Fossil|w/ CCS', 'Primary Energy|Nuclear', 'Primary Energy|Renewables (incl. Biomass)']].sum(axis=1) / x['Primary Energy']
-
-lcspe = (pd.pivot(lcspe, columns='Variable', index=['IMP_marker', 'Model', 'Scenario', 'Year'], values='Value')
-           .sort_values(['Scenario', 'Year'])
-           .reset_index().rename_axis(columns=None)
-           .assign(Value=calc_lcspe)
-           .drop(columns=var))
-
-lcspe = process_scenarios(lcspe).assign(Value=lambda x: x['Value'].round(2))  # percentage
+low_carbon = ['Primary Energy|Fossil|w/ CCS', 'Primary Energy|Nuclear', 'Primary Energy|Renewables (incl. Biomass)']
+lcspe = np.nansum([get_var(v) for v in low_carbon], axis=0) / get_var('Primary Energy')  # missing components count as zero
 
 # %% [markdown]
 # ## Non-energy GHG emissions (NONNRG)
 # To retrieve non-energy GHG emissions the energy-related GHG emissions are deducted from the total GHG emissions, using IPCC AR6 global warming potentials to convert each GHG in CO<sub>2eq</sub>.
 
 # %%
-# Filter only necessary variables
-var = ['Emissions|CO2','Emissions|CO2|Energy', 'Emissions|CH4','Emissions|CH4|Energy',
-        'Emissions|N2O','Emissions|N2O|Energy', 'Emissions|F-Gases']
-nonnrg = dfc.loc[dfc['Variable'].isin(var)]
-
-# Calculate the non-energy GHG emissions
-calc_nonnrg = lambda x: x['Emissions|CO2'] - x['Emissions|CO2|Energy'] + (x['Emissions|CH4'] - x['Emissions|CH4|Energy'])*29.8 + (x['Emissions|N2O'] - x['Emissions|N2O|Energy'])*0.273 + x['Emissions|F-Gases']
-
-nonnrg = (pd.pivot(nonnrg, columns='Variable', index=['IMP_marker', 'Model', 'Scenario', 'Year'], values='Value')
-            .sort_values(['Scenario', 'Year'])
-            .reset_index().rename_axis(columns=None)
-            .assign(Value=calc_nonnrg)
-            .drop(columns=var))
-
-nonnrg = process_scenarios(nonnrg).assign(Value=lambda x: x['Value'].round(0).div(1000))  # to obtain values in Gt
+# Calculate the non-energy GHG emissions as a weighted sum of the total and energy-related emissions of each gas
+gwp = {'Emissions|CO2': 1, 'Emissions|CO2|Energy': -1,
+       'Emissions|CH4': 29.8, 'Emissions|CH4|Energy': -29.8,
+       'Emissions|N2O': 0.273, 'Emissions|N2O|Energy': -0.273,
+       'Emissions|F-Gases': 1}
+nonnrg = np.tensordot(np.array(list(gwp.values()), dtype='float32'), np.stack([get_var(v) for v in gwp]), axes=1)
 
 # %% [markdown]
 # ## CSV output
@@ -247,10 +295,15 @@ nonnrg = process_scenarios(nonnrg).assign(Value=lambda x: x['Value'].round(0).di
 # The file *constraints.csv* in the output of this script becomes the input of the next script *02_tiam-fr_vs_constraints.py*
 
 # %%
-dfs = {'ghg': ghg, 'lcspe': lcspe, 'fed': fed, 'esfe': esfe,
-       'co2elc': co2elc, 'ccsfos': ccsfos, 'nonnrg': nonnrg}
-out = (pd.concat(dfs, names=['Variable']).reset_index('Variable')
-        .pivot_table(index=['Scenario', 'Year'], columns='Variable', values='Value', sort=False))
+metrics = {'ghg': ghg, 'lcspe': lcspe, 'fed': fed, 'esfe': esfe,
+           'co2elc': co2elc, 'ccsfos': ccsfos, 'nonnrg': nonnrg}
+
+# Decimals and divisor applied to each metric (e.g. 1000 to obtain values in Gt)
+rounding = {'ghg': (0, 1000), 'lcspe': (2, 1), 'fed': (0, 1), 'esfe': (2, 1),
+            'co2elc': (0, 1), 'ccsfos': (0, 1000), 'nonnrg': (0, 1000)}
+
+out = process_scenarios(metrics, wide.index, years)
+out = out.round({var: decimals for var, (decimals, _) in rounding.items()}) / [div for _, div in rounding.values()] + 0.0  # + 0.0 turns -0.0 into 0.0
 out.to_csv(OUTDIR1 / 'constraints.csv')
 
 # %% [markdown]
@@ -316,6 +369,43 @@ emission_units = {
     "Emissions|cC4F8": "kt cC4F8 / yr"
 }
 
+# Characters not allowed in the names of the CSV files written by load_ar6_emissions
+UNSAFE_CHARS = re.compile(r'[^\w\-\.]+')
+
+# Variables and units renamed to match MAGICC inputs template
+VAR_RENAME = {
+    "Emissions|PFC|C6F14": "Emissions|C6F14",
+    "Emissions|CO2|AFOLU": "Emissions|CO2|MAGICC AFOLU",
+    "Emissions|CO2|Energy and Industrial Processes": "Emissions|CO2|MAGICC Fossil and Industrial",
+    "Emissions|HFC|HFC125": "Emissions|HFC125",
+    "Emissions|HFC|HFC134a": "Emissions|HFC134a",
+    "Emissions|HFC|HFC143a": "Emissions|HFC143a",
+    "Emissions|HFC|HFC227ea": "Emissions|HFC227ea",
+    "Emissions|HFC|HFC23": "Emissions|HFC23",
+    "Emissions|HFC|HFC245fa": "Emissions|HFC245fa",
+    "Emissions|HFC|HFC32": "Emissions|HFC32",
+    "Emissions|HFC|HFC43-10": "Emissions|HFC4310mee"
+}
+
+UNIT_RENAME = {"kt HFC43-10/yr": "kt HFC4310mee / yr"}
+
+
+def remap(values, mapping):
+    """Replaces the values found in mapping, looking each distinct value up once through the categories of the column.
+    """
+    return values.astype('category').map(lambda value: mapping.get(value, value)).astype(object)
+
+
+def group_quantiles(df, year_cols, q):
+    """Computes the quantiles q of the year columns for each variable and unit in a single pass, ignoring missing values, as one frame per quantile (empty when df is).
+    """
+    arr = df[year_cols].to_numpy(dtype=float)
+    groups = df.groupby(['Variable', 'Unit']).indices
+    index = pd.MultiIndex.from_arrays([[var for var, _ in groups], [unit for _, unit in groups]], names=['Variable', 'Unit'])
+
+    stats = np.stack([nanquantile(arr[rows], q) for rows in groups.values()], axis=1) if groups else np.empty((len(q), 0, len(year_cols)))
+    return [pd.DataFrame(stat, index=index, columns=year_cols).reset_index() for stat in stats]
+
 
 # %%
 def load_ar6_emission_percentiles(cat):
@@ -341,66 +431,27 @@ def load_ar6_emission_percentiles(cat):
     with ZipFile(archive) as zipfile:
         # Process database
         cols = ['Model', 'Scenario', 'Region', 'Variable', 'Unit'] + [str(2015)] + [str(i) for i in range(2020, 2101, 10)]
-        data = pd.read_csv(zipfile.open('AR6_Scenarios_Database_World_v1.1.csv'), usecols=cols)        
-        df = data[(data['Variable'].isin(variables)) & (data['Region'] == 'World')].copy()
+        chunks = pd.read_csv(zipfile.open('AR6_Scenarios_Database_World_v1.1.csv'), usecols=cols, chunksize=250_000)
+        df = pd.concat([chunk[chunk['Variable'].isin(variables) & (chunk['Region'] == 'World')] for chunk in chunks], ignore_index=True)
 
-        # Process metadata
-        cols = ['Model', 'Scenario', 'Category']
-        meta = pd.read_excel(zipfile.open('AR6_Scenarios_Database_metadata_indicators_v1.1.xlsx'), sheet_name='meta_Ch3vetted_withclimate', usecols=cols)
+    # Process metadata
+    meta = load_meta(cols=('Model', 'Scenario', 'Category'), archive=archive)
 
     # Combine dataframes
-    cols = ['Model', 'Scenario', 'Region', 'Variable', 'Unit', 'Year', 'Value', 'Category']
     df = meta.merge(df, on=['Model', 'Scenario'], how='right')
-    df = pd.melt(df, id_vars=df.columns[:6], var_name='Year', value_name='Value')
 
     df = df[df['Category'] == cat].drop(columns='Category')
 
     # Adjusting variables names to match MAGICC inputs template
-    df.loc[:, "Variable"] = df["Variable"].replace({
-                                "Emissions|PFC|C6F14": "Emissions|C6F14",
-                                "Emissions|CO2|AFOLU": "Emissions|CO2|MAGICC AFOLU",
-                                "Emissions|CO2|Energy and Industrial Processes": "Emissions|CO2|MAGICC Fossil and Industrial",
-                                "Emissions|HFC|HFC125": "Emissions|HFC125",
-                                "Emissions|HFC|HFC134a": "Emissions|HFC134a",
-                                "Emissions|HFC|HFC143a": "Emissions|HFC143a",
-                                "Emissions|HFC|HFC227ea": "Emissions|HFC227ea",
-                                "Emissions|HFC|HFC23": "Emissions|HFC23",
-                                "Emissions|HFC|HFC245fa": "Emissions|HFC245fa",
-                                "Emissions|HFC|HFC32": "Emissions|HFC32",
-                                "Emissions|HFC|HFC43-10": "Emissions|HFC4310mee"
-                                })
-
-    df.loc[:, "Unit"] = df["Unit"].replace({
-                               "kt HFC43-10/yr": "kt HFC4310mee / yr"
-                              })
-
-    # Pivot dataframe
-    cols = ['Model', 'Scenario', 'Region', 'Variable', 'Unit']
-    df = df.pivot_table(index=cols, columns='Year', values='Value').reset_index()
+    df["Variable"] = remap(df["Variable"], VAR_RENAME)
+    df["Unit"] = remap(df["Unit"], UNIT_RENAME)
 
     # Convert year columns to numeric
     for col in year_cols:
         df[col] = pd.to_numeric(df[col], errors='coerce')
 
-    # Percentile computation
-    def percentile(col, q):
-        valid = col.dropna().to_numpy()
-        if valid.size == 0:
-            return np.nan
-        return np.percentile(valid, q)
-
-    # Group by variable and unit
-    grouped = df.groupby(['Variable', 'Unit'])[year_cols]
-
-    # Apply aggregation for each percentile
-    df_p5  = grouped.aggregate(lambda col: percentile(col, 5)).reset_index()
-    df_p50 = grouped.aggregate(lambda col: percentile(col, 50)).reset_index()
-    df_p95 = grouped.aggregate(lambda col: percentile(col, 95)).reset_index()
-
-    # Name columns properly
-    df_p5.columns  = ['Variable','Unit'] + year_cols
-    df_p50.columns = ['Variable','Unit'] + year_cols
-    df_p95.columns = ['Variable','Unit'] + year_cols
+    # The three percentiles of each variable and unit
+    df_p5, df_p50, df_p95 = group_quantiles(df, year_cols, np.array([0.05, 0.50, 0.95]))
 
     # Add metadata columns in consistent order
     for label, df_out in zip(['p5','p50','p95'], [df_p5, df_p50, df_p95]):
@@ -421,7 +472,11 @@ df2 = load_ar6_emission_percentiles('C5')
 # ## This last function can be used to extract emissions from a given scenario and model
 
 # %%
-def load_ar6_emissions(model, scen):
+def load_ar6_emissions_batch(pairs):
+    """
+    Write the MAGICC emission inputs of each (model, scenario) pair,
+    reading the database only once for all pairs.
+    """
     # AR6 variables to be processed
     archive = DATADIR / "1668008312256-AR6_Scenarios_Database_World_v1.1.csv.zip"
 
@@ -432,45 +487,29 @@ def load_ar6_emissions(model, scen):
             'Emissions|OC', 'Emissions|SF6', 'Emissions|Sulfur', 'Emissions|VOC'
             ]
 
-    # Import the database and metadata of scenarios and a subset of variables
+    # Import the database of the requested scenarios and a subset of variables
     with ZipFile(archive) as zipfile:
-        # Process database
         cols = ['Model', 'Scenario', 'Region', 'Variable', 'Unit'] + [str(2015)] + [str(i) for i in range(2020, 2101, 10)]
-        data = pd.read_csv(zipfile.open('AR6_Scenarios_Database_World_v1.1.csv'), usecols=cols)        
-        df = data[(data['Variable'].isin(variables)) & (data['Model'] == model) & (data['Scenario'] == scen)].copy()
+        chunks = pd.read_csv(zipfile.open('AR6_Scenarios_Database_World_v1.1.csv'), usecols=cols, chunksize=250_000)
+        data = pd.concat([chunk[chunk['Variable'].isin(variables) & pd.MultiIndex.from_frame(chunk[['Model', 'Scenario']]).isin(pairs)]
+                          for chunk in chunks], ignore_index=True)
+
+    year_cols = [col for col in data.columns if col.isdigit()]
+    groups = dict(list(data.groupby(['Model', 'Scenario'], sort=False)))
+
+    for model, scen in pairs:
+        df = groups.get((model, scen), data.iloc[:0])
 
         # If a variable is missing, insert it and set 0 values for each period
-        df['Variable'] = df['Variable'].astype(str)
-        for var in variables:
-            if var not in df['Variable'].values:
-                year_cols = [col for col in df.columns if col.isdigit()]
-                new_row = {
-                    "Model": model,   # or use the appropriate values from df
-                    "Region": "World",
-                    "Scenario": scen,
-                    "Unit": emission_units.get(var, "Unknown variable"),
-                    "Variable": var,
-                }
-                for col in year_cols:
-                    new_row[col] = 0.0
-                    
-                df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
+        missing = pd.Index(variables).difference(df['Variable'], sort=False)
+        new_rows = pd.DataFrame({"Model": model, "Region": "World", "Scenario": scen,
+                                 "Unit": [emission_units.get(var, "Unknown variable") for var in missing],
+                                 "Variable": missing} | {col: 0.0 for col in year_cols})
+        df = pd.concat([df, new_rows], ignore_index=True)
 
         # Adjusting variables names to match MAGICC inputs template
-        df.loc[:, "Variable"] = df["Variable"].replace({
-                                    "Emissions|PFC|C6F14": "Emissions|C6F14",
-                                    "Emissions|CO2|AFOLU": "Emissions|CO2|MAGICC AFOLU",
-                                    "Emissions|CO2|Energy and Industrial Processes": "Emissions|CO2|MAGICC Fossil and Industrial",
-                                    "Emissions|HFC|HFC125": "Emissions|HFC125",
-                                    "Emissions|HFC|HFC134a": "Emissions|HFC134a",
-                                    "Emissions|HFC|HFC143a": "Emissions|HFC143a",
-                                    "Emissions|HFC|HFC227ea": "Emissions|HFC227ea",
-                                    "Emissions|HFC|HFC23": "Emissions|HFC23",
-                                    "Emissions|HFC|HFC245fa": "Emissions|HFC245fa",
-                                    "Emissions|HFC|HFC32": "Emissions|HFC32",
-                                    "Emissions|HFC|HFC43-10": "Emissions|HFC4310mee"
-                                    })
-        df.loc[:, "Unit"] = df["Unit"].replace({"Mt NO2/yr": "Mt NOx/yr"})
+        df["Variable"] = remap(df["Variable"], VAR_RENAME)
+        df["Unit"] = remap(df["Unit"], {"Mt NO2/yr": "Mt NOx/yr"})
 
         df = df.rename(columns={'Model': 'model', 'Region': 'region', 'Scenario': 'scenario', 'Unit': 'unit', 'Variable': 'variable'})
 
@@ -480,13 +519,17 @@ def load_ar6_emissions(model, scen):
         df = df[first_cols + rest_cols]
 
         df = df.sort_values(by='variable', ascending=True)
-    
-    # Sanitize arguments' names before saving
-    csv_model = re.sub(r'[^\w\-\.]+', '_', model).replace('.', 'p')
-    csv_scen  = re.sub(r'[^\w\-\.]+', '_', scen).replace('.', 'p')
-    cache = OUTDIR2 / f"AR6_{csv_model}_{csv_scen}.csv"
 
-    df.to_csv(cache, index=False)
+        # Sanitize arguments' names before saving
+        csv_model = UNSAFE_CHARS.sub('_', model).replace('.', 'p')
+        csv_scen  = UNSAFE_CHARS.sub('_', scen).replace('.', 'p')
+        cache = OUTDIR2 / f"AR6_{csv_model}_{csv_scen}.csv"
+
+        df.to_csv(cache, index=False)
+
+
+def load_ar6_emissions(model, scen):
+    load_ar6_emissions_batch([(model, scen)])
 
 
 # %%
@@ -512,14 +555,15 @@ def process_scenarios(df, year_col="Year", value_col="Value"):
     """
     out = df.copy()
 
-    # 1) Distribution thresholds per year (across all scenarios in df)
-    q = (
-        out.groupby(year_col)[value_col]
-           .quantile([0.05, 0.50, 0.95])
-           .unstack()
-           .rename(columns={0.05: "P5", 0.50: "P50", 0.95: "P95"})
-           .reset_index()
-    )
+    # 1) Distribution thresholds per year (across all scenarios in df),
+    # computed at once on a (scenarios x years) array padded with NaN
+    years, year_pos = np.unique(out[year_col].to_numpy(), return_inverse=True)
+    row_pos = out.groupby(year_col).cumcount().to_numpy()
+    values = np.full((row_pos.max(initial=-1) + 1, len(years)), np.nan, dtype=np.result_type(out[value_col].dtype, np.float32))
+    values[row_pos, year_pos] = out[value_col].to_numpy()
+
+    q = pd.DataFrame(nanquantile(values, np.array([0.05, 0.50, 0.95])).T, columns=["P5", "P50", "P95"])
+    q.insert(0, year_col, years)
 
     # 2) Merge thresholds onto each scenario row
     out = out.merge(q, on=year_col, how="left")
@@ -555,18 +599,12 @@ def process_scenarios(df, year_col="Year", value_col="Value"):
 
 
 # %%
-# Filter variables needed to calculate the low-carbon share of primary energy
-var = ['Primary Energy', 'Primary Energy|Fossil|w/ CCS','Primary Energy|Nuclear', 'Primary Energy|Renewables (incl. Biomass)']
-lcspe = dfc.loc[dfc['Variable'].isin(var)]
-
-# Calculate the low-carbon share of primary energy
-calc_lcspe = lambda x: x[['Primary Energy|Fossil|w/ CCS', 'Primary Energy|Nuclear', 'Primary Energy|Renewables (incl. Biomass)']].sum(axis=1) / x['Primary Energy']
-
-lcspe = (pd.pivot(lcspe, columns='Variable', index=['IMP_marker', 'Model', 'Scenario', 'Year'], values='Value')
-           .sort_values(['Scenario', 'Year'])
-           .reset_index().rename_axis(columns=None)
-           .assign(Value=calc_lcspe)
-           .drop(columns=var))
+# Recompute the low-carbon share of primary energy from the float64 wide frame, so that the published values keep full precision
+lcspe = np.nansum([wide[v].to_numpy() for v in low_carbon], axis=0) / wide['Primary Energy'].to_numpy()
+lcspe = (pd.DataFrame(lcspe, index=wide.index.reorder_levels(['IMP_marker', 'Model', 'Scenario']), columns=years)
+           .dropna(how='all')  # scenarios not reporting primary energy
+           .melt(ignore_index=False, value_name='Value').reset_index()
+           .sort_values(['Scenario', 'Year', 'IMP_marker', 'Model'], ignore_index=True))
 
 lcspe = process_scenarios(lcspe).assign(Value=lambda x: x['Value'].round(2))  # percentage
 
@@ -602,66 +640,27 @@ def load_ar6_SSP_emission_percentiles(cat, SSP):
     with ZipFile(archive) as zipfile:
         # Process database
         cols = ['Model', 'Scenario', 'Region', 'Variable', 'Unit'] + [str(2015)] + [str(i) for i in range(2020, 2101, 10)]
-        data = pd.read_csv(zipfile.open(filename), usecols=cols)        
-        df = data[(data['Variable'].isin(variables)) & (data['Region'] == 'World')].copy()
+        chunks = pd.read_csv(zipfile.open(filename), usecols=cols, chunksize=250_000)
+        df = pd.concat([chunk[chunk['Variable'].isin(variables) & (chunk['Region'] == 'World')] for chunk in chunks], ignore_index=True)
 
-        # Process metadata
-        cols = ['Model', 'Scenario', 'Category', 'SSP']
-        meta = pd.read_excel(zipfile.open('AR6_Scenarios_Database_metadata_indicators_v1.1.xlsx'), sheet_name='meta', usecols=cols)
+    # Process metadata
+    meta = load_meta('meta', ('Model', 'Scenario', 'Category', 'SSP'), archive)
 
     # Combine dataframes
-    cols = ['Model', 'Scenario', 'Region', 'Variable', 'Unit', 'Year', 'Value', 'Category', 'SSP']
     df = meta.merge(df, on=['Model', 'Scenario'], how='right')
-    df = pd.melt(df, id_vars=df.columns[:7], var_name='Year', value_name='Value')
 
     df = df[(df['Category'] == cat) & (df['SSP'] == SSP)].drop(columns=['Category', 'SSP'])
 
     # Adjusting variables names to match MAGICC inputs template
-    df.loc[:, "Variable"] = df["Variable"].replace({
-                                "Emissions|PFC|C6F14": "Emissions|C6F14",
-                                "Emissions|CO2|AFOLU": "Emissions|CO2|MAGICC AFOLU",
-                                "Emissions|CO2|Energy and Industrial Processes": "Emissions|CO2|MAGICC Fossil and Industrial",
-                                "Emissions|HFC|HFC125": "Emissions|HFC125",
-                                "Emissions|HFC|HFC134a": "Emissions|HFC134a",
-                                "Emissions|HFC|HFC143a": "Emissions|HFC143a",
-                                "Emissions|HFC|HFC227ea": "Emissions|HFC227ea",
-                                "Emissions|HFC|HFC23": "Emissions|HFC23",
-                                "Emissions|HFC|HFC245fa": "Emissions|HFC245fa",
-                                "Emissions|HFC|HFC32": "Emissions|HFC32",
-                                "Emissions|HFC|HFC43-10": "Emissions|HFC4310mee"
-                                })
-
-    df.loc[:, "Unit"] = df["Unit"].replace({
-                               "kt HFC43-10/yr": "kt HFC4310mee / yr"
-                              })
-
-    # Pivot dataframe
-    cols = ['Model', 'Scenario', 'Region', 'Variable', 'Unit']
-    df = df.pivot_table(index=cols, columns='Year', values='Value').reset_index()
+    df["Variable"] = remap(df["Variable"], VAR_RENAME)
+    df["Unit"] = remap(df["Unit"], UNIT_RENAME)
 
     # Convert year columns to numeric
     for col in year_cols:
         df[col] = pd.to_numeric(df[col], errors='coerce')
 
-    # Percentile computation
-    def percentile(col, q):
-        valid = col.dropna().to_numpy()
-        if valid.size == 0:
-            return np.nan
-        return np.percentile(valid, q)
-
-    # Group by variable and unit
-    grouped = df.groupby(['Variable', 'Unit'])[year_cols]
-
-    # Apply aggregation for each percentile
-    df_p5  = grouped.aggregate(lambda col: percentile(col, 5)).reset_index()
-    df_p50 = grouped.aggregate(lambda col: percentile(col, 50)).reset_index()
-    df_p95 = grouped.aggregate(lambda col: percentile(col, 95)).reset_index()
-
-    # Name columns properly
-    df_p5.columns  = ['Variable','Unit'] + year_cols
-    df_p50.columns = ['Variable','Unit'] + year_cols
-    df_p95.columns = ['Variable','Unit'] + year_cols
+    # The three percentiles of each variable and unit
+    df_p5, df_p50, df_p95 = group_quantiles(df, year_cols, np.array([0.05, 0.50, 0.95]))
 
     # Add metadata columns in consistent order
     for label, df_out in zip(['p5','p50','p95'], [df_p5, df_p50, df_p95]):
@@ -705,62 +704,27 @@ def load_ar6_emission_percentile_cat(cat, centile):
     with ZipFile(archive) as zipfile:
         # Process database
         cols = ['Model', 'Scenario', 'Region', 'Variable', 'Unit'] + [str(2015)] + [str(i) for i in range(2020, 2101, 10)]
-        data = pd.read_csv(zipfile.open('AR6_Scenarios_Database_World_v1.1.csv'), usecols=cols)        
-        df = data[(data['Variable'].isin(variables)) & (data['Region'] == 'World')].copy()
+        chunks = pd.read_csv(zipfile.open('AR6_Scenarios_Database_World_v1.1.csv'), usecols=cols, chunksize=250_000)
+        df = pd.concat([chunk[chunk['Variable'].isin(variables) & (chunk['Region'] == 'World')] for chunk in chunks], ignore_index=True)
 
-        # Process metadata
-        cols = ['Model', 'Scenario', 'Category']
-        meta = pd.read_excel(zipfile.open('AR6_Scenarios_Database_metadata_indicators_v1.1.xlsx'), sheet_name='meta_Ch3vetted_withclimate', usecols=cols)
+    # Process metadata
+    meta = load_meta(cols=('Model', 'Scenario', 'Category'), archive=archive)
 
     # Combine dataframes
-    cols = ['Model', 'Scenario', 'Region', 'Variable', 'Unit', 'Year', 'Value', 'Category']
     df = meta.merge(df, on=['Model', 'Scenario'], how='right')
-    df = pd.melt(df, id_vars=df.columns[:6], var_name='Year', value_name='Value')
 
     df = df[df['Category'] == cat].drop(columns='Category')
 
     # Adjusting variables names to match MAGICC inputs template
-    df.loc[:, "Variable"] = df["Variable"].replace({
-                                "Emissions|PFC|C6F14": "Emissions|C6F14",
-                                "Emissions|CO2|AFOLU": "Emissions|CO2|MAGICC AFOLU",
-                                "Emissions|CO2|Energy and Industrial Processes": "Emissions|CO2|MAGICC Fossil and Industrial",
-                                "Emissions|HFC|HFC125": "Emissions|HFC125",
-                                "Emissions|HFC|HFC134a": "Emissions|HFC134a",
-                                "Emissions|HFC|HFC143a": "Emissions|HFC143a",
-                                "Emissions|HFC|HFC227ea": "Emissions|HFC227ea",
-                                "Emissions|HFC|HFC23": "Emissions|HFC23",
-                                "Emissions|HFC|HFC245fa": "Emissions|HFC245fa",
-                                "Emissions|HFC|HFC32": "Emissions|HFC32",
-                                "Emissions|HFC|HFC43-10": "Emissions|HFC4310mee"
-                                })
-
-    df.loc[:, "Unit"] = df["Unit"].replace({
-                               "kt HFC43-10/yr": "kt HFC4310mee / yr"
-                              })
-
-    # Pivot dataframe
-    cols = ['Model', 'Scenario', 'Region', 'Variable', 'Unit']
-    df = df.pivot_table(index=cols, columns='Year', values='Value').reset_index()
+    df["Variable"] = remap(df["Variable"], VAR_RENAME)
+    df["Unit"] = remap(df["Unit"], UNIT_RENAME)
 
     # Convert year columns to numeric
     for col in year_cols:
         df[col] = pd.to_numeric(df[col], errors='coerce')
 
-    # Percentile computation
-    def percentile(col, q):
-        valid = col.dropna().to_numpy()
-        if valid.size == 0:
-            return np.nan
-        return np.percentile(valid, q)
-
-    # Group by variable and unit
-    grouped = df.groupby(['Variable', 'Unit'])[year_cols]
-
-    # Apply aggregation for each percentile
-    df_centile  = grouped.aggregate(lambda col: percentile(col, centile)).reset_index()
-
-    # Name columns properly
-    df_centile.columns  = ['Variable','Unit'] + year_cols
+    # The percentile of each variable and unit
+    df_centile, = group_quantiles(df, year_cols, np.array([centile / 100]))
 
     # Add metadata columns in consistent order
     for label, df_out in zip([f"{centile}"], [df_centile]):
@@ -9,12 +9,16 @@ import sqlite3
 
 DATADIR = pathlib.Path('data')
 
-# Imports the database where TIAM-FR outputs are collected
-conn = sqlite3.connect(DATADIR / 'c1.db')  # to be uploaded from Zenodo
+# Imports the database where TIAM-FR outputs are collected, read-only so that the downloaded file is left untouched
+conn = sqlite3.connect(f"file:{DATADIR / 'c1.db'}?mode=ro", uri=True)  # to be uploaded from Zenodo
+
+# Map the database file and keep its pages and temporary sorts in memory
+for pragma in ('PRAGMA mmap_size=268435456', 'PRAGMA cache_size=-262144', 'PRAGMA temp_store=MEMORY'):
+    conn.execute(pragma)
 
 # %% [markdown]
 # ## Greenhouse gases (GHG)
-# This query simply extract the net amount of GHG emissions in GtCO<sub>2eq</sub>.
+# This query simply extract the net amount of GHG emissions in GtCO<sub>2eq</sub>. The non-energy GHG emissions are summed in the same pass over the table.
 
 # %%
 qs = """SELECT
@@ -26,13 +30,21 @@ qs = """SELECT
          commodity = 'GHG'
       THEN
          PV
-   END)/ 1000000 AS Value
+   END)/ 1000000 AS GHG,
+   SUM(
+   CASE
+      WHEN
+         Commodity IN ('NONNRG')
+      THEN
+         PV
+   END)/ 1000000 AS NONNRG
 FROM
    Var_Comnet
 GROUP BY
    Scenario, Period;"""
 
-ghg = pd.read_sql_query(qs, conn)
+comnet = pd.read_sql_query(qs, conn)
+ghg = comnet[['Scenario', 'Year', 'GHG']].rename(columns={'GHG': 'Value'})
 
 # %% [markdown]
 # ## Fossil CO<sub>2</sub> captured and stored (CCSFOS)
@@ -68,10 +80,16 @@ ccsfos = pd.read_sql_query(qs, conn)
 
 # %% [markdown]
 # ## Low-carbon share of primary energy (LCSPE)
-# This query extracts the amount of low carbon and fossil primary energy to calculate the low carbon share. It ensures that primary energy commodities are not accounted for if they are processed by transfer processes (TU) and gazification/liquefaction processes (UPR) in the case of natural gas (GASNGA).
+# This query extracts the amount of low carbon and fossil primary energy to calculate the low carbon share. It ensures that primary energy commodities are not accounted for if they are processed by transfer processes (TU) and gazification/liquefaction processes (UPR) in the case of natural gas (GASNGA). The sum of global low-carbon primary energy is then divided by the total primary energy within the same query.
 
 # %%
 qs = """SELECT
+   Scenario,
+   Year,
+   SUM(CASE WHEN Label = 'Low-carbon' THEN Value END) /
+   (SUM(CASE WHEN Label = 'Low-carbon' THEN Value END) + SUM(CASE WHEN Label = 'Fossil' THEN Value END)) AS Value
+FROM (
+SELECT
    Scenario,
    Period AS Year,
    'Low-carbon' AS 'Label',
@@ -143,37 +161,46 @@ WHERE
    OR Process LIKE 'EZ%'
    OR Process LIKE 'INM%MIX%CC')
 GROUP BY
-   Scenario,Label,Year;"""
+   Scenario,Label,Year
+)
+GROUP BY
+   Scenario, Year
+HAVING -- years missing one of the two parts have no share
+   SUM(CASE WHEN Label = 'Low-carbon' THEN Value END) IS NOT NULL AND
+   SUM(CASE WHEN Label = 'Fossil' THEN Value END) IS NOT NULL
+ORDER BY
+   Scenario, Year;"""
 
 lcspe = pd.read_sql_query(qs, conn)
 
-# %%
-lcspe = (lcspe.pivot_table(index=['Scenario', 'Year'], columns='Label', values='Value', aggfunc='sum')
-              .assign(Value=lambda x: x['Low-carbon'] / (x.pop('Low-carbon') + x.pop('Fossil'))) # divides the sum of global low-carbon primary energy by the total primary energy
-              .reset_index().rename_axis(columns=None))
-
 # %% [markdown]
 # ## Final energy demand (FED)
+# The final energy processes are listed in *mapping.csv*, the processes delivering electricity to end-use sectors are also queried for ESFE below.
 
 # %%
-qs = """SELECT 
+dmap = pd.read_csv(DATADIR / 'mapping.csv', sep=';').set_index('Commodity')['Label']
+fe_processes = dmap.index[dmap == 'Final energy process'].tolist()
+elc_processes = ['FT_INDELC', 'FT_AGRELC', 'FT_COMELC', 'FT_RESELC', 'FT_TRAELC']
+processes = fe_processes + elc_processes
+
+qs = f"""SELECT 
    Scenario, 
    Period as 'Year',
    Process,
    SUM(Pv)/1000 as 'Value' 
 FROM 
    Var_Fin 
+WHERE
+   Process IN ({', '.join('?' * len(processes))})
 GROUP BY
    Scenario,
    Process,
    Period;"""
 
-fed = pd.read_sql_query(qs, conn)
+fin = pd.read_sql_query(qs, conn, params=processes)
 
 # %%
-dmap = pd.read_csv(DATADIR / 'mapping.csv', sep=';').set_index('Commodity')['Label']
-label = fed.pop('Process').map(dmap)
-fed = fed.loc[label == 'Final energy process']
+fed = fin.loc[fin['Process'].isin(fe_processes)].drop(columns='Process')
 fed = fed.groupby(['Scenario', 'Year'], as_index=False).sum()
 
 # %% [markdown]
@@ -182,6 +209,11 @@ fed = fed.groupby(['Scenario', 'Year'], as_index=False).sum()
 
 # %%
 qs = """SELECT
+   Scenario,
+   Year,
+   SUM(CASE WHEN Commodity = 'ELCCO2N' THEN Value END) / SUM(CASE WHEN Commodity = 'ELC' THEN Value END) * 3.6 AS Value -- x3.6 to transform MWh to PJ
+FROM (
+SELECT
    Scenario,
    Period AS Year,
    Commodity,
@@ -205,55 +237,37 @@ FROM
 WHERE
    Commodity IN ('ELCCO2N')
 GROUP BY
-   Scenario, Period, Commodity;"""
+   Scenario, Period, Commodity
+)
+GROUP BY
+   Scenario, Year
+HAVING -- years missing the emissions or the generation have no intensity
+   SUM(CASE WHEN Commodity = 'ELCCO2N' THEN Value END) IS NOT NULL AND
+   SUM(CASE WHEN Commodity = 'ELC' THEN Value END) IS NOT NULL
+ORDER BY
+   Scenario, Year;"""
 
 co2elc = pd.read_sql_query(qs, conn)
 
-# %%
-co2elc = (co2elc.pivot_table(index=['Scenario', 'Year'], columns='Commodity', values='Value')
-                .assign(Value=lambda x: x.pop('ELCCO2N') / x.pop('ELC') * 3.6)  # x3.6 to transform MWh to PJ
-                .reset_index().rename_axis(columns=None))
-
 # %% [markdown]
 # ## Electricity share of final energy (ESFE)
-# This query simply calculates the ratio of electricity to final energy demand.
+# The electricity of final energy demand is read from the final energy inputs queried above, to calculate the ratio of electricity to final energy demand.
 
 # %%
-qs = """SELECT 
-   Scenario,
-   Period as 'Year',
-   SUM(PV)/1000 as 'ELCFIN'
-FROM VAR_FIn
-WHERE Process IN ('FT_INDELC', 'FT_AGRELC', 'FT_COMELC', 'FT_RESELC', 'FT_TRAELC')
-GROUP BY Scenario, Period;"""
-
-esfe = pd.read_sql_query(qs, conn)
+esfe = fin.loc[fin['Process'].isin(elc_processes)].drop(columns='Process')
+esfe = esfe.groupby(['Scenario', 'Year'], as_index=False).sum().rename(columns={'Value': 'ELCFIN'})
 
 # %%
-esfe = (esfe.merge(fed, on=['Scenario', 'Year'])
-            .assign(Value=lambda x: x.pop('ELCFIN') / x['Value']))
+esfe = esfe.merge(fed, on=['Scenario', 'Year'])
+esfe = pd.DataFrame({'Scenario': esfe['Scenario'], 'Year': esfe['Year'],
+                     'Value': esfe['ELCFIN'].to_numpy() / esfe['Value'].to_numpy()})
 
 # %% [markdown]
 # ## Non-energy GHG emissions (NONNRG)
-# This query simply extracts the net amount of non-energy GHG emissions.
+# The net amount of non-energy GHG emissions is extracted by the GHG query.
 
 # %%
-qs = """SELECT
-   Scenario,
-   Period as Year,
-   SUM(
-   CASE
-      WHEN
-         Commodity IN ('NONNRG') 
-      THEN
-         PV 
-   END)/ 1000000 AS Value
-FROM
-   Var_Comnet 
-GROUP BY
-   Scenario, Period;"""
-
-nonnrg = pd.read_sql_query(qs, conn)
+nonnrg = comnet[['Scenario', 'Year', 'NONNRG']].rename(columns={'NONNRG': 'Value'})
 
 # %% [markdown]
 # ## Exportation
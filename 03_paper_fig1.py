@@ -20,61 +20,76 @@
 # %%
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.dataset as ds
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import matplotlib.patheffects as mpe
 import scienceplots
 import pathlib
+from functools import lru_cache
 
 mpl.style.use(["science", "nature"])
 DATADIR = pathlib.Path('data')
 FIGOUT = pathlib.Path('figures')
+YEARS = np.arange(2000, 2101, dtype='int16')
+YEAR_COLS = [str(year) for year in YEARS]
 
+from matplotlib.collections import LineCollection
 from matplotlib.ticker import MultipleLocator
 from matplotlib.ticker import AutoMinorLocator, NullLocator
 
 
 # %%
+@lru_cache(maxsize=None)
 def load_ar6_climate(cat):
     """Imports the database of scenarios according to the category specified by the user.
     """
     var = 'AR6 climate diagnostics|Surface Temperature (GSAT)|MAGICCv7.5.3|50.0th Percentile'
-    
-    df = (pd.read_csv(DATADIR / "AR6_Scenarios_Database_World_ALL_CLIMATE_subset_and_metadata_v1.1.csv")
-             .loc[lambda x: x['Variable'].eq(var) & x['Category'].eq(cat) & x['Year'].ge(2000),
-                  ['Model', 'Scenario', 'Year', 'Value']])
+    source = DATADIR / "AR6_Scenarios_Database_World_ALL_CLIMATE_subset_and_metadata_v1.1.csv"
+    cache = source.with_suffix('.parquet')
 
-    return df
+    # Convert the extract once, sorted so that the row groups of a variable and category can be skipped on their statistics
+    if not cache.exists() or cache.stat().st_mtime < source.stat().st_mtime:
+        (pd.read_csv(source)
+           .sort_values(['Variable', 'Category', 'Model', 'Scenario', 'Year'])
+           .to_parquet(cache, index=False, compression='zstd', row_group_size=20_000))
+
+    df = pd.read_parquet(cache, columns=['Model', 'Scenario', 'Year', 'Value'],
+                         filters=[('Variable', '==', var), ('Category', '==', cat), ('Year', '>=', 2000)])
+
+    return df.astype({'Model': 'category', 'Scenario': 'category', 'Year': 'int16', 'Value': 'float32'})
 
 
 # %%
+@lru_cache(maxsize=None)
 def load_magicc(cat):
     """Imports the precompiled 5th, 50th, 75th and 95th percentiles emissions pathways according to the category specified by the user."""
     var = 'Surface Temperature'
-    year_cols = [str(i) for i in range(2000, 2101)]
-    cols = ['scenario', 'variable', 'quantile'] + year_cols
     scenarios = ['p5', 'p50', 'p75', 'p95']
+    sources = [DATADIR / f"{cat}_{scen}_magicc.csv" for scen in scenarios]
+    cache = DATADIR / f"{cat}_magicc.parquet"
+
+    # Reuse the long table unless one of the percentile files has been regenerated since
+    if cache.exists() and cache.stat().st_mtime > max(source.stat().st_mtime for source in sources):
+        return pd.read_parquet(cache)
+
+    # Scan the four files as one dataset, keeping only the median of the variable
+    types = {'scenario': pa.string(), 'variable': pa.string(), 'quantile': pa.float64()} | {col: pa.float32() for col in YEAR_COLS}
+    files = ds.dataset([str(source) for source in sources],
+                       format=ds.CsvFileFormat(convert_options=pacsv.ConvertOptions(column_types=types)))
+    df = files.to_table(columns=['scenario'] + YEAR_COLS,
+                        filter=(ds.field('variable') == var) & (ds.field('quantile') == 0.50)).to_pandas()
+
+    # Long format, one row per scenario and year, built straight from the wide values
+    values = df[YEAR_COLS].to_numpy()
+    df = pd.DataFrame({'Scenario': pd.Categorical(df['scenario'].to_numpy().repeat(len(YEARS))),
+                       'Year': np.tile(YEARS, len(df)),
+                       'Value': values.ravel()})
+    df.to_parquet(cache, index=False)
 
-    dfs = []
-    for scen in scenarios:
-        df = pd.read_csv(DATADIR / f"{cat}_{scen}_magicc.csv", usecols=cols)
-
-        # Filter for the correct variable and quantile
-        df = df[(df['variable'] == var) & (df['quantile'] == 0.50)]
-
-        # Ensure only the relevant columns are kept
-        df = df[['scenario'] + year_cols]
-
-        # Rename and melt
-        df = df.rename(columns={'scenario': 'Scenario'})
-        df = pd.melt(df, id_vars='Scenario', var_name='Year', value_name='Value')
-
-        # Convert types
-        df = df.astype({'Year': int, 'Value': float})
-
-        dfs.append(df)
-
-    return pd.concat(dfs, ignore_index=True)
+    return df
 
 
 
@@ -98,20 +113,24 @@ pw_colors = {
     f'{cat} median pathway': 'green'
 }
 
-magicc['Scenario'] = magicc['Scenario'].replace({
+# Relabel the categories rather than every row, on a new frame since the loaded one is cached
+magicc = magicc.assign(Scenario=magicc['Scenario'].cat.rename_categories({
     f'{cat}_p5': f'{cat} 5$^{{th}}$ pathway',
     f'{cat}_p75': f'{cat} 75$^{{th}}$ pathway',
     f'{cat}_p95': f'{cat} 95$^{{th}}$ pathway',
-    f'{cat}_p50': f'{cat} median pathway'})
+    f'{cat}_p50': f'{cat} median pathway'}))
 
 # Re-plot
-for scen, subset in magicc.groupby('Scenario', sort=False):
+for scen, subset in magicc.groupby('Scenario', sort=False, observed=True):
     color = pw_colors.get(scen)
     ax.plot(subset['Year'], subset['Value'], label=scen, zorder=1, color=color)
 
-for i, (*_, subset) in enumerate(ar6.groupby(['Model', 'Scenario'])):
-    label = f'{cat} scenarios' if i == 0 else '_nolegend_'
-    ax.plot(subset['Year'], subset['Value'], color='gray', alpha=0.5, lw=0.2, label=label, zorder=0)
+# All AR6 trajectories share the same years: draw them as one collection
+paths = ar6.pivot(index=['Model', 'Scenario'], columns='Year', values='Value')
+years = np.broadcast_to(paths.columns.to_numpy(), paths.shape)
+segments = np.stack([years, paths.to_numpy()], axis=-1)
+ax.add_collection(LineCollection(segments, colors='gray', alpha=0.5, linewidths=0.2,
+                                 capstyle='projecting', label=f'{cat} scenarios', zorder=0, rasterized=True))
 
 
 ax.legend(loc='lower left')
@@ -35,6 +35,7 @@ import matplotlib.pyplot as plt
 import matplotlib.patheffects as mpe
 import scienceplots
 import pathlib
+import re
 
 DATADIR = pathlib.Path('data')
 FIGOUT = pathlib.Path('figures')
@@ -50,12 +51,15 @@ df = df[~df['Scenario'].isin(filtered)]
 
 # Maps different groups
 gmap = {
-    r'^IMP-.*': 'imp',
-    r'Median|\d+th|base': 'stat',  # groups the median and the 5th and 95th percentiles
-    r'^[bgc].*|tab2': 'emissions',  # groups the pathways constrained by a combination of median pathways related to GHG (see Table 2 of the manuscript)
-    r'^[nf].*|tab4': 'energy', # groups the pathways constrained by a combination of median pathways related to energy (see Table 3 of the manuscript)
+    re.compile(r'^IMP-.*'): 'imp',
+    re.compile(r'Median|\d+th|base'): 'stat',  # groups the median and the 5th and 95th percentiles
+    re.compile(r'^[bgc].*|tab2'): 'emissions',  # groups the pathways constrained by a combination of median pathways related to GHG (see Table 2 of the manuscript)
+    re.compile(r'^[nf].*|tab4'): 'energy', # groups the pathways constrained by a combination of median pathways related to energy (see Table 3 of the manuscript)
 }
-df['Group'] = df['Scenario'].replace(gmap, regex=True)
+# The first matching pattern gives the group, unmatched scenarios keep their name
+df['Group'] = np.select([df['Scenario'].str.contains(pattern) for pattern in gmap], list(gmap.values()),
+                        default=df['Scenario'].to_numpy())
+df = df.astype({'Scenario': 'category', 'Group': 'category'})
 
 # %% [markdown]
 # ## Plotting rules
@@ -102,9 +106,17 @@ kwds = {
     "tab4": {"color": "darkred", "linestyle": "solid", "linewidth": 1},
 }
 
+# Style of each drawn pathway: its group defaults overridden by its own parameters
+STYLES = {
+    **{scen: kwds['stat'] | kwds[scen] for scen in ('Median', '5th', '95th')},
+    **{scen: kwds['imp'] | kwds[scen] for scen in kwds if scen.startswith('IMP-')},
+    'tab2': kwds['emissions'] | kwds['tab2'],
+    'tab4': kwds['energy'] | kwds['tab4'],
+}
+
 
 # %%
-def make_plot(var, df, fig_id):
+def make_plot(var, piv, fig_id):
     width, height = mpl.rcParams["figure.figsize"]
     fig, ax = plt.subplots(figsize=(width, height), dpi=300, constrained_layout=True)
     
@@ -112,34 +124,33 @@ def make_plot(var, df, fig_id):
     if fig_id:
         ax.set_title(f'({fig_id})', loc='left', fontsize=10)
 
-    piv = df.pivot_table(index=['Group', 'Scenario'], columns='Year', values=var)
-    grp = piv.groupby('Group')
-
     # Legend
     lines = {}
     area = {}
     
     # STAT group
-    df1 = grp.get_group('stat').droplevel('Group')
-    lines['Median'] = ax.plot(df1.loc['Median'], **(kwds['stat'] | kwds['Median']))
-    lines['5th'] = ax.plot(df1.loc['5th'], **(kwds['stat'] | kwds['5th']))
-    lines['95th'] = ax.plot(df1.loc['95th'], **(kwds['stat'] | kwds['95th']))
+    df1 = piv.loc['stat']
+    lines['Median'] = ax.plot(df1.loc['Median'], **STYLES['Median'])
+    lines['5th'] = ax.plot(df1.loc['5th'], **STYLES['5th'])
+    lines['95th'] = ax.plot(df1.loc['95th'], **STYLES['95th'])
     area['stat'] = ax.fill_between(df1.columns, df1.loc['5th'], df1.loc['95th'], color=kwds["stat"]["color"], alpha=0.5)
     
     # IMP group
-    df1 = grp.get_group('imp').droplevel('Group')
+    df1 = piv.loc['imp']
     for scen, data in df1.iterrows():
-        lines[scen] = ax.plot(data, **(kwds['imp'] | kwds[scen]))
+        lines[scen] = ax.plot(data, **STYLES[scen])
     
     # ENERGY group
-    df1 = grp.get_group('energy').droplevel('Group')
-    area['energy'] = ax.fill_between(df1.columns, df1.min(axis=0), df1.max(axis=0), color=kwds["energy"]["color"], alpha=0.5)
-    lines['tab4'] = ax.plot(df1.loc['tab4'], **(kwds['energy'] | kwds['tab4']))
+    df1 = piv.loc['energy']
+    values = df1.to_numpy()
+    area['energy'] = ax.fill_between(df1.columns, np.nanmin(values, axis=0), np.nanmax(values, axis=0), color=kwds["energy"]["color"], alpha=0.5, rasterized=True)
+    lines['tab4'] = ax.plot(df1.loc['tab4'], **STYLES['tab4'])
     
     # EMISSIONS group
-    df1 = grp.get_group('emissions').droplevel('Group')
-    area['emissions'] = ax.fill_between(df1.columns, df1.min(axis=0), df1.max(axis=0), color=kwds["emissions"]["color"], alpha=0.5)
-    lines['tab2'] = ax.plot(df1.loc['tab2'], **(kwds['emissions'] | kwds['tab2']))
+    df1 = piv.loc['emissions']
+    values = df1.to_numpy()
+    area['emissions'] = ax.fill_between(df1.columns, np.nanmin(values, axis=0), np.nanmax(values, axis=0), color=kwds["emissions"]["color"], alpha=0.5, rasterized=True)
+    lines['tab2'] = ax.plot(df1.loc['tab2'], **STYLES['tab2'])
     
     ax.set_ylabel(chart_elements[var]['ylabel'])
     ax.tick_params(axis='x', labelrotation=45)
@@ -153,12 +164,14 @@ def make_plot(var, df, fig_id):
 # %% editable=true slideshow={"slide_type": ""}
 (FIGOUT / "paper").mkdir(parents=True, exist_ok=True)
 
-for var in chart_elements:
-    subdf = df[['Scenario', 'Year', 'Group', var]].copy()
+# Each (Scenario, Year) is unique: pivot all the variables at once and slice per figure
+piv = df.pivot(index=['Group', 'Scenario'], columns='Year', values=list(chart_elements))
 
-    fig, ax = make_plot(var, subdf, chart_elements[var].get('fig_id'))
+for var in chart_elements:
+    fig, ax = make_plot(var, piv[var], chart_elements[var].get('fig_id'))
     fig.savefig(FIGOUT / "paper" / f"{var}.png", bbox_inches='tight')
     plt.show()
+    plt.close(fig)
 
 # %% [markdown]
 # # Plot the legend
@@ -167,80 +180,22 @@ for var in chart_elements:
 from matplotlib.lines import Line2D
 from matplotlib.patches import Rectangle
 
-width, height = mpl.rcParams["figure.figsize"]
-fig_legend, ax_legend = plt.subplots(figsize=(width, height), dpi=300)
-
-legend = {
-    'Median pathway': Line2D([0], [0], **(kwds['stat'] | kwds['Median'])),
-    'Ensemble of energy-constrained pathways': Rectangle((0, 0), 1, 1, **kwds['energy']),
-    'IMP-Low Demand (IMP-LD)': Line2D([0], [0], **(kwds['imp'] | kwds['IMP-LD'])),
-
-    'Full combination of median GHG-constrained pathways': Line2D([0], [0], **(kwds['emissions'] | kwds['tab2'])),
-    '5th-95th percentile ensemble': Rectangle((0, 0), 1, 1, **kwds['stat']),
-    'IMP-Sustainable Pathway (IMP-SP) ': Line2D([0], [0], **(kwds['imp'] | kwds['IMP-SP'])),
-
-    'Full combination of median energy-constrained pathways': Line2D([0], [0], **(kwds['energy'] | kwds['tab4'])),
-    'Ensemble of GHG-constrained pathways': Rectangle((0, 0), 1, 1, **kwds['emissions']),
-    'IMP-Renewables (IMP-Ren)': Line2D([0], [0], **(kwds['imp'] | kwds['IMP-Ren'])),
-}
-
-ax_legend.legend(handles=legend.values(), labels=legend.keys(), loc='center', ncol=3)
-ax_legend.axis('off')
-plt.subplots_adjust(top=1e-6, bottom=0)
-fig_legend.savefig(FIGOUT / "paper" / "legend.png", bbox_inches='tight')
-
-plt.show()
-
-# %%
-from matplotlib.lines import Line2D
-from matplotlib.patches import Rectangle
-
-width, height = mpl.rcParams["figure.figsize"]
-fig_legend, ax_legend = plt.subplots(figsize=(width, height), dpi=300)
-
-legend = {
-    '5th-95th percentile ensemble': Rectangle((0, 0), 1, 1, **kwds['stat']),
-    'Median pathway': Line2D([0], [0], **(kwds['stat'] | kwds['Median'])),
-    'IMP-Low Demand (IMP-LD)': Line2D([0], [0], **(kwds['imp'] | kwds['IMP-LD'])),
-
-    'Ensemble of GHG-constrained pathways': Rectangle((0, 0), 1, 1, **kwds['emissions']),
-    'Full combination of median GHG-constrained pathways': Line2D([0], [0], **(kwds['emissions'] | kwds['tab2'])),
-    'IMP-Sustainable Pathway (IMP-SP) ': Line2D([0], [0], **(kwds['imp'] | kwds['IMP-SP'])),
-
-    'Ensemble of energy-constrained pathways': Rectangle((0, 0), 1, 1, **kwds['energy']),
-    'Full combination of median energy-constrained pathways': Line2D([0], [0], **(kwds['energy'] | kwds['tab4'])),
-    'IMP-Renewables (IMP-Ren)': Line2D([0], [0], **(kwds['imp'] | kwds['IMP-Ren'])),
-}
-
-ax_legend.legend(handles=legend.values(), labels=legend.keys(), loc='center', ncol=3)
-ax_legend.axis('off')
-plt.subplots_adjust(top=1e-6, bottom=0)
-fig_legend.savefig(FIGOUT / "paper" / "legend.png", bbox_inches='tight')
-
-plt.show()
-
-# %%
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-from matplotlib.lines import Line2D
-from matplotlib.patches import Rectangle
-
 # --- Create legend figure ---
 width, height = mpl.rcParams["figure.figsize"]
 fig_legend, ax_legend = plt.subplots(figsize=(width, height), dpi=300)
 
 legend = {
     '5th-95th percentile ensemble': Rectangle((0, 0), 1, 1, **kwds['stat']),
-    'Median pathway': Line2D([0], [0], **(kwds['stat'] | kwds['Median'])),
-    'IMP-Low Demand (IMP-LD)': Line2D([0], [0], **(kwds['imp'] | kwds['IMP-LD'])),
+    'Median pathway': Line2D([0], [0], **STYLES['Median']),
+    'IMP-Low Demand (IMP-LD)': Line2D([0], [0], **STYLES['IMP-LD']),
 
     'Ensemble of GHG-constrained pathways': Rectangle((0, 0), 1, 1, **kwds['emissions']),
-    'Full combination of median GHG-constrained pathways': Line2D([0], [0], **(kwds['emissions'] | kwds['tab2'])),
-    'IMP-Sustainable Pathway (IMP-SP)': Line2D([0], [0], **(kwds['imp'] | kwds['IMP-SP'])),
+    'Full combination of median GHG-constrained pathways': Line2D([0], [0], **STYLES['tab2']),
+    'IMP-Sustainable Pathway (IMP-SP)': Line2D([0], [0], **STYLES['IMP-SP']),
 
     'Ensemble of energy-constrained pathways': Rectangle((0, 0), 1, 1, **kwds['energy']),
-    'Full combination of median energy-constrained pathways': Line2D([0], [0], **(kwds['energy'] | kwds['tab4'])),
-    'IMP-Renewables (IMP-Ren)': Line2D([0], [0], **(kwds['imp'] | kwds['IMP-Ren'])),
+    'Full combination of median energy-constrained pathways': Line2D([0], [0], **STYLES['tab4']),
+    'IMP-Renewables (IMP-Ren)': Line2D([0], [0], **STYLES['IMP-Ren']),
 }
 
 # --- Draw legend ---